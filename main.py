@@ -1,90 +1,189 @@
 import os
+
+# Use the high performance mode of the Xet uploader. Must be set before huggingface_hub is imported.
+os.environ.setdefault("HF_XET_HIGH_PERFORMANCE", "1")
+
 from huggingface_hub import HfApi
+import asyncio
+import atexit
 import time
+import random
 import runpod
-import json
-import requests
+import orjson
+import uuid
+import aiohttp
+from urllib.parse import urlsplit
 from pathlib import Path
 
 hf_api = HfApi(token=os.environ["HF_TOKEN"])
 
+
+def log_prewarm_failure(future):
+    """
+    Done callback for the HuggingFace pre-warm, logs it if the request failed.
+
+    args:
+        future (Future): The future returned by hf_api.run_as_future.
+    """
+    if future.exception() is not None:
+        print(f"🦖 Could not pre-warm HuggingFace connection: {future.exception()}")
+
+
+# Pre-warm the HuggingFace session on HfApi's worker thread, the one upload_file(run_as_future=True) runs on,
+# without blocking the cold start.
+hf_api.run_as_future(hf_api.whoami).add_done_callback(log_prewarm_failure)
+
 # Repo in HuggingFace to upload outputs to.
 HF_REPO_UPLOAD = "notkenski/inferences"
 # Path object of dir. where script is ran.
 curr_dir = Path.cwd()
 # ComfyUI workflow to be used in this script.
 COMFY_WORKFLOW_FILE_NAME = "example_workflow-api.json"
+# Full path to the ComfyUI workflow.
+COMFY_WORKFLOW_PATH = curr_dir / "workflows" / COMFY_WORKFLOW_FILE_NAME
 # Host where API server is running.
 COMFY_API_HOST = "127.0.0.1:8188"
 # Max attempts to connect to host.
 COMFY_API_MAX_ATTEMPTS = 100
-# Max delay between attempts to connect to host.
+# Max delay between attempts to connect to host, in seconds.
 COMFY_API_MAX_DELAY = 5
+# Base delay for the exponential backoff between attempts, in seconds.
+COMFY_API_BASE_DELAY = 0.1
 # Output path for ComfyUI images.
 COMFY_OUTPUT_PATH = Path("comfyui") / "output"
+# Max time to wait for a queued workflow to finish generating, in seconds.
+COMFY_GENERATION_TIMEOUT = 500
+# Max jobs this worker runs at once. Only raise this if ComfyUI can actually run jobs in parallel,
+# otherwise extra jobs sit in its queue and eat into their generation timeout.
+MAX_CONCURRENT_JOBS = int(os.environ.get("MAX_CONCURRENT_JOBS", 1))
 
-def mutate_workflow(hyperparams: dict, lora: str = ""):
+# Parsed workflow template, loaded once and copied per request.
+with open(COMFY_WORKFLOW_PATH, "rb") as wf_file:
+    WORKFLOW_TEMPLATE = orjson.loads(wf_file.read())
+
+# Recycle the worker process after this many jobs, 0 keeps it alive indefinitely.
+REFRESH_WORKER_EVERY = int(os.environ.get("REFRESH_WORKER_EVERY", 0))
+# Number of jobs handled by this worker process.
+jobs_handled = 0
+
+# Shared session so calls to the ComfyUI API server reuse keep-alive connections. Created on first use,
+# since it has to be bound to the running event loop.
+comfy_session = None
+
+# Whether the ComfyUI API server has already been reached by this worker process.
+server_ready = False
+
+# Print extra debugging info when the DEBUG env. var is set.
+DEBUG = bool(os.environ.get("DEBUG"))
+
+
+def get_comfy_session():
     """
-    Mutates the original workflow template and returns a modified dict.
+    Returns the shared aiohttp session for the ComfyUI API server, creating it if needed.
+    """
+    global comfy_session
+
+    if comfy_session is None or comfy_session.closed:
+        # Each in-flight job holds one WebSocket plus at most one HTTP request.
+        comfy_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=MAX_CONCURRENT_JOBS * 2))
+
+    return comfy_session
+
+
+def close_comfy_session():
+    """
+    Closes the shared ComfyUI session on worker shutdown.
+
+    RunPod owns the event loop and has closed it by the time we exit, so the close runs on a fresh one.
     """
-    wf_path = curr_dir.joinpath("workflows", COMFY_WORKFLOW_FILE_NAME)
+    if comfy_session is not None and not comfy_session.closed:
+        try:
+            asyncio.run(comfy_session.close())
+        except Exception as e:
+            print(f"Could not close ComfyUI session: {e}")
+
 
-    with open(wf_path, "r") as wf_file:
-        parsed_workflow = json.load(wf_file)
+atexit.register(close_comfy_session)
 
-        original_seed = parsed_workflow["25"]["inputs"]["noise_seed"]
-        print(f"✨ Original seed: {original_seed}")
+
+def mutate_workflow(hyperparams: dict, lora: str = ""):
+    """
+    Mutates the original workflow template and returns a modified dict.
+    """
+    # Round-trip through orjson, which is faster than copy.deepcopy for plain JSON data.
+    parsed_workflow = orjson.loads(orjson.dumps(WORKFLOW_TEMPLATE))
 
     # Mutate seed.
     parsed_workflow["25"]["inputs"]["noise_seed"] = hyperparams["noise_seed"]
 
-    modified_seed = parsed_workflow["25"]["inputs"]["noise_seed"]
-    print(f"✨ Modified seed: {modified_seed}")
+    if DEBUG:
+        print(f"✨ Seed: {WORKFLOW_TEMPLATE['25']['inputs']['noise_seed']} -> {hyperparams['noise_seed']}")
 
     return parsed_workflow
 
 
-def process_output_images(outputs: dict):
+def find_output_image(outputs: dict):
     """
-    Grab the outputs and determine how to process the image for return.
+    Find the first image produced by the workflow.
 
     args:
-        todo.
+        outputs (dict): The outputs of the prompt, as returned in its history.
 
     returns:
-        todo.
+        Path | None: Path of the image relative to the ComfyUI output dir, or None if there is no image.
     """
-    output_images = ""
-
     for node_id, node_output in outputs.items():
-        # print(f"✨ {node_id}, {node_output}")
+        for image in node_output.get("images", []):
+            return Path(image["subfolder"]) / image["filename"]
 
-        if "images" in node_output:
-            for image in node_output["images"]:
-                output_images = Path(image["subfolder"]) / image["filename"]
+    return None
 
-    local_images_path = COMFY_OUTPUT_PATH / output_images
-    print(f"✨ Local images path: {local_images_path}")
 
-    if local_images_path.exists():
-        try:
-            hf_api.upload_file(
-                path_or_fileobj=local_images_path,
-                path_in_repo=local_images_path.name,
-                repo_id=HF_REPO_UPLOAD
-            )
-            print(f"🦖 Successfully uploaded to HuggingFace.")
+async def process_output_images(outputs: dict):
+    """
+    Grab the outputs and determine how to process the image for return.
 
-            return {"status": "success", "message": f"Successfully uploaded output to HuggingFace."}
-        except Exception as e:
-            return {"status": "error", "message": f"Error uploading to HF: {e}"}
+    args:
+        outputs (dict): The outputs of the prompt, as returned in its history.
+
+    returns:
+        dict: The status of the upload and a message.
+    """
+    output_images = find_output_image(outputs)
+
+    if output_images is None:
+        print(f"🦖 The workflow did not produce any images.")
+        return {"status": "error", "message": f"The workflow did not produce any images."}
+
+    local_images_path = COMFY_OUTPUT_PATH / output_images
+    print(f"✨ Local images path: {local_images_path}")
 
-    else:
+    try:
+        os.stat(local_images_path)
+    except FileNotFoundError:
         print(f"🦖 The image does not exist in the output folder at: {local_images_path}")
         return {"status": "error", "message": f"The image does not exist in the output folder at: {local_images_path}"}
+    except OSError as e:
+        print(f"🦖 Could not access the image at: {local_images_path}: {e}")
+        return {"status": "error", "message": f"Could not access the image at {local_images_path}: {e}"}
 
+    try:
+        # Upload on HfApi's worker thread so the event loop stays free for other jobs.
+        upload_future = hf_api.upload_file(
+            path_or_fileobj=local_images_path,
+            path_in_repo=local_images_path.name,
+            repo_id=HF_REPO_UPLOAD,
+            run_as_future=True
+        )
+        await asyncio.wrap_future(upload_future)
+        print(f"🦖 Successfully uploaded to HuggingFace.")
+
+        return {"status": "success", "message": f"Successfully uploaded output to HuggingFace."}
+    except Exception as e:
+        return {"status": "error", "message": f"Error uploading to HF: {e}"}
 
-def get_history(prompt_id: str):
+
+async def get_history(prompt_id: str):
     """
     Retrieve the history given the prompt_id.
 
@@ -97,79 +196,164 @@ def get_history(prompt_id: str):
     # with urllib.request.urlopen(f"http://{COMFY_API_HOST}/history/{prompt_id}") as response:
     #     return json.loads(response.read())
 
-    req = requests.get(f"http://{COMFY_API_HOST}/history/{prompt_id}")
-    parsed_req = req.json()
+    async with get_comfy_session().get(f"http://{COMFY_API_HOST}/history/{prompt_id}") as req:
+        parsed_req = orjson.loads(await req.read())
 
     return parsed_req
 
 
-def queue_workflow(workflow: dict):
+async def queue_workflow(workflow: dict, client_id: str):
     """
     Queue workflow to be sent to and processed by the ComfyUI API server.
 
     args:
         workflow (dict): A dictionary containing the workflow to be processed.
+        client_id (str): ID of the WebSocket client that should receive progress events.
 
     Returns:
         dict: JSON response from ComfyUI after sent.
     """
-    data = json.dumps({"prompt": workflow}).encode("utf-8")
+    data = orjson.dumps({"prompt": workflow, "client_id": client_id})
 
-    req = requests.post(f"http://{COMFY_API_HOST}/prompt", data=data)
-    parsed_req = req.json()
+    async with get_comfy_session().post(f"http://{COMFY_API_HOST}/prompt", data=data) as req:
+        parsed_req = orjson.loads(await req.read())
 
     print(parsed_req)
 
     return parsed_req
 
 
-def check_server(url: str, attempts: int = 10, delay: int = 2):
+def backoff_delay(attempt: int, cap: float = COMFY_API_MAX_DELAY):
+    """
+    Exponential backoff with full jitter.
+
+    Args:
+        attempt (int): The current attempt number, starting at 0.
+        cap (float, optional): Upper bound on the delay, in seconds.
+
+    Returns:
+        float: A random delay between 0 and min(cap, base * 2 ** attempt).
+    """
+    return random.uniform(0, min(cap, COMFY_API_BASE_DELAY * (2 ** attempt)))
+
+
+async def wait_for_completion(ws: aiohttp.ClientWebSocketResponse, prompt_id: str):
+    """
+    Wait on the ComfyUI WebSocket until the given prompt has finished executing.
+
+    args:
+        ws (aiohttp.ClientWebSocketResponse): Connected WebSocket subscribed with the prompt's client_id.
+        prompt_id (str): The ID of the prompt to wait for.
+    """
+    async for msg in ws:
+        # Binary frames are latent previews, skip them.
+        if msg.type != aiohttp.WSMsgType.TEXT:
+            continue
+
+        msg = orjson.loads(msg.data)
+
+        # ComfyUI signals completion with an "executing" event whose node is None.
+        if msg["type"] == "executing":
+            data = msg["data"]
+
+            if data["node"] is None and data["prompt_id"] == prompt_id:
+                return
+
+    raise ConnectionError("ComfyUI WebSocket closed before the prompt finished.")
+
+
+async def check_server(url: str, attempts: int = 10, delay: float = 2):
     """
     Checks to see if the ComfyUI API server is live.
 
     Args:
         url (str): URL to check for server.
-        attempts (int, optional): How many tries to reach server.
-        delay (int, optional): Time between each attempt in ms.
+        attempts (int, optional): Together with delay, sets how long to keep trying (attempts * delay seconds).
+        delay (float, optional): Max time between each attempt in seconds.
 
     Returns:
          boolean: True if the server can be reached, otherwise false.
     """
 
-    for i in range(attempts):
-        print(f"Attempt {i}")
+    parsed_url = urlsplit(url)
+    host, port = parsed_url.hostname, parsed_url.port or 80
 
-        try:
-            server_res = requests.get(url)
+    # Backoff with jitter sleeps less than delay on average, so bound the wait by time rather than attempt count.
+    deadline = time.monotonic() + attempts * delay
+    i = 0
+
+    while True:
+        if DEBUG:
+            print(f"Attempt {i}")
 
-            # If the status code is 200, the server is live and running.
-            if server_res.status_code == 200:
-                print(f"Success. ComfyUI API server is live and reachable.")
-                return True
-        except requests.RequestException as e:
+        try:
+            # Cheap TCP probe first, only pay for an HTTP request once the port is open.
+            _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout=0.5)
+            writer.close()
+            await writer.wait_closed()
+
+            async with get_comfy_session().get(url) as server_res:
+                # If the status code is 200, the server is live and running.
+                if server_res.status == 200:
+                    print(f"Success. ComfyUI API server is live and reachable.")
+                    return True
+        except (OSError, asyncio.TimeoutError, aiohttp.ClientError) as e:
             # If there is an exception, the server may not be ready yet.
             pass
 
-        # Wait for delay before retrying.
-        time.sleep(delay)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+
+        # Back off (capped at delay) before retrying.
+        await asyncio.sleep(min(backoff_delay(i, cap=delay), remaining))
+        i += 1
 
     # If we are getting a status code other than 200 and no exceptions, there is failed connection.
-    print(f"Failed to connect to ComfyUI server at {url} after {attempts} attempts.")
+    print(f"Failed to connect to ComfyUI server at {url} after {attempts * delay} seconds.")
     return False
 
 
+def validate_job_dict(job_input: dict):
+    """
+    Validates job input that is already a dictionary.
+
+    Args:
+        job_input (dict): Dictionary containing job information to validate.
+
+    Returns:
+         tuple: A tuple containing the validated data and an error message, if any.
+                The structure is: (validated data, error message)
+    """
+    hf_lora = job_input.get("hf_lora")
+    hyperparams = job_input.get("hyperparams")
+
+    if hf_lora is None or hyperparams is None:
+        return None, "Need to provide both hf_lora and hyperparams in the request."
+
+    if not isinstance(hyperparams, dict) or "noise_seed" not in hyperparams:
+        return None, "hyperparams must be an object containing noise_seed."
+
+    # Return validated data with no error.
+    return {"hf_lora": hf_lora, "hyperparams": hyperparams}, None
+
+
 def validate_job_input(job_input):
     """
     Validates the input for the job.
 
     Args:
-        job_input (dict): Dictionary containing job information to validate.
+        job_input (dict | str): Dictionary, or JSON string, containing job information to validate.
 
     Returns:
          tuple: A tuple containing the validated data and an error message, if any.
                 The structure is: (validated data, error message)
     """
 
+    # RunPod hands us a dict in the normal case, so check that first.
+    if type(job_input) is dict:
+        return validate_job_dict(job_input)
+
     # Validate if job input is provided.
     if job_input is None:
         return None, "Job input is not provided."
@@ -177,23 +361,20 @@ def validate_job_input(job_input):
     # Check if job input is a string and parse it into JSON.
     if isinstance(job_input, str):
         try:
-            job_input = json.loads(job_input)
-        except json.decoder.JSONDecodeError:
+            job_input = orjson.loads(job_input)
+        except orjson.JSONDecodeError:
             return None, "Job input is not valid JSON."
 
-    # Validate workflow in job input.
-    hf_lora = job_input["hf_lora"]
-    hyperparams = job_input["hyperparams"]
+    if not isinstance(job_input, dict):
+        return None, "Job input must be a JSON object."
 
-    if hf_lora is None or hyperparams is None:
-        return None, "Need to provide both hf_lora and hyperparams in the request."
+    return validate_job_dict(job_input)
 
-    # Return validated data with no error.
-    return {"hf_lora": hf_lora, "hyperparams": hyperparams}, None
 
+async def handler(job):
+    global server_ready, jobs_handled
 
-def handler(job):
-    job_input = job['input']
+    job_input = job.get('input')
 
     # ====== Make sure the job input is valid. ======
 
@@ -209,7 +390,9 @@ def handler(job):
 
     # ====== Check if ComfyUI API server is live. ======
 
-    check_server(f"http://{COMFY_API_HOST}", COMFY_API_MAX_ATTEMPTS, COMFY_API_MAX_DELAY)
+    # Skip the check on warm workers, the server stays up for the life of the process.
+    if not server_ready:
+        server_ready = await check_server(f"http://{COMFY_API_HOST}", COMFY_API_MAX_ATTEMPTS, COMFY_API_MAX_DELAY)
 
     # ====== Grab the workflow and queue it. ======
 
@@ -219,41 +402,50 @@ def handler(job):
 
     modified_workflow = mutate_workflow(hyperparams=hyperparams, lora=hf_lora)
 
-    try:
-        queued_workflow = queue_workflow(workflow=modified_workflow)
-        prompt_id = queued_workflow["prompt_id"]
+    client_id = str(uuid.uuid4())
 
-        print(f"✨ Queued workflow with a returned ID of: {prompt_id}")
+    try:
+        ws = await get_comfy_session().ws_connect(f"ws://{COMFY_API_HOST}/ws?clientId={client_id}")
     except Exception as e:
-        return {"status": "error", "message": f"Error queuing workflow: {str(e)}"}
+        return {"status": "error", "message": f"Error connecting to ComfyUI WebSocket: {str(e)}"}
 
-    # ====== Poll for completion. ======
+    try:
+        try:
+            queued_workflow = await queue_workflow(workflow=modified_workflow, client_id=client_id)
+            prompt_id = queued_workflow["prompt_id"]
 
-    current_retry = 0
+            print(f"✨ Queued workflow with a returned ID of: {prompt_id}")
+        except Exception as e:
+            return {"status": "error", "message": f"Error queuing workflow: {str(e)}"}
 
-    try:
-        while current_retry < COMFY_API_MAX_ATTEMPTS:
-            history = get_history(prompt_id=prompt_id)
+        # ====== Wait for completion. ======
+
+        try:
+            await asyncio.wait_for(
+                wait_for_completion(ws=ws, prompt_id=prompt_id),
+                timeout=COMFY_GENERATION_TIMEOUT
+            )
+            history = await get_history(prompt_id=prompt_id)
+        except asyncio.TimeoutError:
+            return {"status": "error", "message": f"Timed out waiting for image generation."}
+        except Exception as e:
+            return {"status": "error", "message": f"Error waiting for image generation: {str(e)}"}
+    finally:
+        await ws.close()
 
-            if prompt_id in history and history[prompt_id].get("outputs"):
-                break
-            else:
-                time.sleep(COMFY_API_MAX_DELAY)
-                current_retry += 1
+    if not history.get(prompt_id, {}).get("outputs"):
+        return {"status": "error", "message": f"No outputs found in history for prompt: {prompt_id}"}
 
-        else:
-            return {"status": "error", "message": f"Exceeded the maximum number of retries."}
-    except Exception as e:
-        return {"status": "error", "message": f"Error waiting for image generation: {str(e)}"}
+    process_results = await process_output_images(outputs=history[prompt_id].get("outputs"))
 
-    process_results = process_output_images(outputs=history[prompt_id].get("outputs"))
+    jobs_handled += 1
 
     job_results = {
         **process_results,
-        "refresh_worker": True
+        "refresh_worker": REFRESH_WORKER_EVERY > 0 and jobs_handled % REFRESH_WORKER_EVERY == 0
     }
 
     return job_results
 
 if __name__ == '__main__':
-    runpod.serverless.start({"handler": handler})
+    runpod.serverless.start({"handler": handler, "concurrency_modifier": lambda current_concurrency: MAX_CONCURRENT_JOBS})